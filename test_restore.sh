@@ -5,14 +5,18 @@
 # Create the test dir if it does not exist.
 mkdir -p test
 
-# Cleanout any "_orig" files created by the undeny.py script.
+# Cleanout any "_orig" files created by older versions of the undeny.py script.
 # The 2>/dev/null is to hide errors when there are no _orig files under test/
 rm -f test/etc/hosts.deny_orig
 find test/var/lib/denyhosts/ -name "*_orig" 2>/dev/null | xargs rm -f 
 
+# Cleanout the snapshots. This assumes SNAPSHOT_DIR in undeny.py has been 
+# set to test/var/lib/denyhosts/.snapshots for testing.
+rm -rf test/var/lib/denyhosts/.snapshots
+
 # Remove temp files created by undeny.py 
-# Note: this will remove other temp files owned by you. 
-find /tmp -maxdepth 1 -name tmp* -user ${USER} -type f | xargs rm -f 
+# These are created in the same directory as the file being edited.
+find test/etc test/var/lib/denyhosts/ -maxdepth 1 -name "tmp*" -type f 2>/dev/null | xargs rm -f 
 
 # Restore the original test files.
 tar xf test_restore.tar
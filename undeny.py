@@ -1,23 +1,38 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 '''
 This script removes IP addresses that have been blocked by denyhosts.
 
-Usage: sudo python ./undeny.py ip_address
+Usage: sudo python3 ./undeny.py ip_address
 Note: a full ip address must be provided. 
 
 This program does the following steps:
 1. Stop denyhosts.
 2. Remove the specified ip_adddress from /etc/hosts.deny and other files in /var/lib/denyhosts/ 
    Reference: http://denyhosts.sourceforge.net/faq.html#3_19
-   - This is done safely using a temp file followed by a copy and a remove. 
-   - The copy is named with "_orig" appended.
-   - If the supplied IP address is not found then the copied and original files will be identical. 
+   - This is done safely using a temp file which is then renamed over the original. 
+   - Before a file is changed for the first time each day, the original is kept 
+     in a dated snapshot directory, e.g. /var/lib/denyhosts/.snapshots/2014.11.06/ 
+   - If the supplied IP address is not found in a file then that file is left alone. 
+   - The files are processed concurrently, one thread per file.
 3. Start denyhosts. 
 
 It does no harm to run this program again or on an IP address that is 
 not in any of the deny hosts files. 
 
+Daemon Mode
+-----------
+
+Each run pays for starting python and importing modules. If undeny is called 
+often, e.g. from a cron job or another tool, it can be left running instead:
+
+    sudo python3 ./undeny.py --daemon
+    echo ip_address | sudo socat - UNIX-CONNECT:/run/undeny.sock
+
+The daemon listens on SOCKET_PATH, which only root can connect to, and 
+replies "OK" or an error for each ip address sent. Requests are handled 
+one at a time as each one stops and starts denyhosts.
+
 Notes on Renaming and Moving Files
 ----------------------------------
 
@@ -29,15 +44,16 @@ You can't use os.rename across different file systems as shown here:
     OSError: [Errno 18] Invalid cross-device link
     >>> 
 
-It's safer to use shutil.copy() and then a shutil.remove()
+So the temp file is created in the same directory as the file being edited. 
+Then os.replace() can be used which is atomic and does not copy any data. 
 
 Permissions
 -----------
 
 On Centos 6.4 the permissions of the files in /var/lib/denyhosts/ are 644 (-rw-r--r--).
 The temp file that we create is readable and writable only by the creating user ID 
-i.e. 600 (-rw-------). Hence after the copy of the temp file overwriting the original 
-denyhosts files we need to chmod the denyhosts files back to 644. 
+i.e. 600 (-rw-------). Hence before the temp file is renamed over the original 
+denyhosts files we need to chmod it to 644 and give it the original file's owner. 
 
 License
 -------
@@ -63,15 +79,19 @@ Versions
 2013.08.19: added test for sudo use
 2014.08.13: File opens now use 'with' and moved into function. Changed logging. Use shutil()
 2014.11.06: Added more comments on what happens.
+2026.10.15: Ported to Python 3. The temp file is renamed into place, the original kept as a hard link.
+2026.10.15: Added --daemon mode listening on a unix socket.
+2026.10.15: Replaced the "_orig" files with daily snapshots under SNAPSHOT_DIR.
 '''
 
-import os, sys, re
-import subprocess
-import shutil       # required as os.rename() cannot be used. 
-import tempfile
+# Modules only needed once we get to editing files are imported in the 
+# functions that use them. This keeps the startup quick when we are just 
+# going to print the usage and exit.
+import os, sys
+import mmap
 import logging
-import datetime
-import socket       # used to validate ip addresses
+import time
+import ipaddress    # used to validate ip addresses
 
 
 ########################
@@ -93,157 +113,441 @@ denyhosts_files = [
     '/var/lib/denyhosts/users-hosts',
     '/var/lib/denyhosts/users-invalid' ]
 
+# Files are snapshotted here, one directory per day, before they are changed.
+SNAPSHOT_DIR = '/var/lib/denyhosts/.snapshots'
+
+# How long in seconds to wait for denyhosts to stop when using D-Bus. 
+# This is a bit longer than systemd's default stop timeout of 90 seconds.
+STOP_TIMEOUT = 100
+
+# The unix socket the daemon listens on when run with --daemon.
+SOCKET_PATH = '/run/undeny.sock'
+
 
 ################
 # Functions here 
 ################
 
 def usage():
-    print ''
-    print 'Usage: sudo python %s IP_address' % sys.argv[0] 
-    print '  The python invocation is required for sudo.'
-    print '  The IP address must be a full dotted-quad ip address.\n' 
+    print('')
+    print('Usage: sudo python3 %s IP_address' % sys.argv[0])
+    print('  The python3 invocation is required for sudo.')
+    print('  The IP address must be a full dotted-quad ip address.')
+    print('   or: sudo python3 %s --daemon' % sys.argv[0])
+    print('  Then send ip addresses, one per line, to %s' % SOCKET_PATH)
+    print('  e.g. echo IP_address | sudo socat - UNIX-CONNECT:%s\n' % SOCKET_PATH)
 
 
 def check_valid_ip(address):
     '''
     Ref: http://stackoverflow.com/questions/11264005/using-a-regex-to-match-ip-addresses-in-python
     Using regex to validate IP address is a bad idea - this will pass
-    999.999.999.999 as valid. Using a socket instead is much better validation
-    and just as easy. 
-    # TODO use except socket.error:
+    999.999.999.999 as valid. socket.inet_aton() is no good either as it 
+    passes short forms like 127.1. The ipaddress module only accepts a full
+    dotted-quad and comparing against its string form also rejects things 
+    like leading zeros.
     '''
 
     try: 
-        error = socket.inet_aton(address)
-        return True
-    except:
+        return str(ipaddress.IPv4Address(address)) == address
+    except ValueError:
         return False
 
 
+def systemd_action(action):
+    '''
+    Starts or stops denyhosts by calling systemd directly over D-Bus. 
+    systemd only queues the job so when stopping we wait until the unit 
+    is no longer active, i.e. denyhosts has finished with its files. 
+    Raises ImportError if pydbus isn't installed or another exception if 
+    systemd can't be reached or denyhosts hasn't stopped within STOP_TIMEOUT.
+    '''
+
+    import pydbus   # optional, lets us talk to systemd without running commands
+
+    bus = pydbus.SystemBus()
+    systemd = bus.get('.systemd1')
+    if action == 'start':
+        systemd.StartUnit('denyhosts.service', 'replace')
+    else:
+        systemd.StopUnit('denyhosts.service', 'replace')
+        unit = bus.get('.systemd1', systemd.GetUnit('denyhosts.service'))
+        # The stop job can be cancelled, e.g. by someone starting denyhosts, 
+        # so don't wait forever.
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while unit.ActiveState not in ('inactive', 'failed'):
+            if time.monotonic() > deadline:
+                raise RuntimeError('denyhosts still %s after %d seconds' 
+                    % (unit.ActiveState, STOP_TIMEOUT))
+            time.sleep(0.1)
+
+
 def denyhosts_action(action):
     '''
     Starts or stops denyhosts if the correct 'action' has been supplied. 
+    If pydbus is installed systemd is asked directly, otherwise or if that 
+    fails we fall back to running systemctl, or service on hosts without 
+    systemd. Starting doesn't wait for denyhosts to be up, stopping does.
     '''
 
+    import shutil, subprocess
+
     if action != 'start' and action != 'stop':
         return False
 
+    try:
+        systemd_action(action)
+    except ImportError:
+        pass    # no pydbus
+    except Exception as e:
+        logging.debug('  D-Bus %s denyhosts failed (%s), trying systemctl' % (action, e))
+    else:
+        logging.debug('  %s denyhosts OK' % action)
+        return True
+
     # start or stop denyhosts
-    #if subprocess.call(['/bin/systemctl', action, 'denyhosts.service']) == 0:
-    if subprocess.call(['service', 'denyhosts', action]) == 0:
+    # Nothing needs denyhosts to be running again so start with --no-block.
+    # A stop must finish before we edit the files or denyhosts could 
+    # write them back, so that waits as usual.
+    if shutil.which('systemctl'):
+        command = ['systemctl', action, 'denyhosts.service']
+        if action == 'start':
+            command.insert(1, '--no-block')
+    else:
+        command = ['service', 'denyhosts', action]
+
+    try:
+        returncode = subprocess.call(command)
+    except OSError as e:
+        logging.error('  Error: could not run %s: %s' % (command[0], e))
+        returncode = None
+
+    if returncode == 0:
         logging.debug('  %s denyhosts OK' % action)
         status = True
     else:
         logging.error('  Error: %s denyhosts failure' % action)
-        print '  Error %s denyhosts failure' % action
+        print('  Error %s denyhosts failure' % action)
         status = False
 
     return status
 
 
+# Characters that can be part of an ip address, see contains_ip().
+ADDRESS_CHARS = b'0123456789.'
+
+def contains_ip(buf, ip_b):
+    '''
+    Returns True if the ip address ip_b (as bytes) appears in buf as a whole 
+    address. buf can be a single line or a whole mmap'ed file. 
+    A plain substring test would also match 11.2.3.4 or 1.2.3.45 
+    when looking for 1.2.3.4 and unblock the wrong hosts, so the characters 
+    either side of a match must not be a digit or a dot. The files have the 
+    ip in forms like "sshd: ip", "ip:..." and "- ip:".
+    '''
+
+    start = buf.find(ip_b)
+    while start != -1:
+        end = start + len(ip_b)
+        if (start == 0 or buf[start - 1] not in ADDRESS_CHARS) and \
+           (end == len(buf) or buf[end] not in ADDRESS_CHARS):
+            return True
+        start = buf.find(ip_b, start + 1)
+    return False
+
+
+def read_if_found(host_file, ip_b):
+    '''
+    Returns the contents of host_file if the ip address ip_b (as bytes) 
+    appears anywhere in it as a whole address, otherwise None. The file is 
+    mmap'ed and searched in place so it's only copied into python when it 
+    has to be rewritten.
+    '''
+
+    with open(host_file, 'rb') as fp:
+        # An empty file can't be mmap'ed.
+        if os.fstat(fp.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if not contains_ip(mm, ip_b):
+                return None
+            # This file will be rewritten and is copied once from start to 
+            # end so tell the kernel that. Files without the ip, including 
+            # ones that only have it inside a longer address, get no hints 
+            # as they stay live and denyhosts reads them again.
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            data = mm[:]
+        # This inode is only kept by the snapshot after the rewrite so drop its pages.
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return data
+
+
+def snapshot_file(host_file):
+    '''
+    Keep host_file in today's directory under SNAPSHOT_DIR. Only the first 
+    snapshot of the day is kept so it holds the file as it was before any 
+    undeny that day, and earlier days are never overwritten. 
+
+    This is a hard link so no data is copied. The temp file is later renamed 
+    over host_file which leaves the link pointing at the original contents. 
+    If a hard link can't be made, e.g. /etc is on a different file system, 
+    we fall back to a copy.
+
+    Returns the snapshot's path if one was made by this call, or None if 
+    there already was one today.
+    '''
+
+    import shutil, tempfile
+
+    snap_dir = os.path.join(SNAPSHOT_DIR, time.strftime('%Y.%m.%d'))
+    os.makedirs(snap_dir, exist_ok=True)
+    snap_file = os.path.join(snap_dir, os.path.basename(host_file))
+    if os.path.exists(snap_file):
+        return None
+    try:
+        os.link(host_file, snap_file)
+    except FileExistsError:
+        return None
+    except OSError:
+        # Copy to a temp name and rename it into place so that a copy that 
+        # fails part way is never taken as today's snapshot.
+        fd, temp_snap = tempfile.mkstemp(dir=snap_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(host_file, temp_snap)
+            os.replace(temp_snap, snap_file)
+        except OSError:
+            os.unlink(temp_snap)
+            raise
+    return snap_file
+
+
 def delete_from_file(host_file, ip):
     '''
     Delete an ip address from a file. The way this is implemented is that 
     we first make a temp copy of the file and copy lines into it that don't 
-    contain the unwanted ip address. After all lines are finished we rename 
-    the original file (to *_orig) and then rename the temp file to what the 
+    contain the unwanted ip address. After all lines are finished we 
+    snapshot the original file and then rename the temp file to what the 
     original file was named. 
 
+    If the ip address is not in the file at all then the file is left alone.
+
     If there are errors then the original file remains the same, the temp 
     file is removed and an error logged.
     '''
 
-    status = False
+    import tempfile
+
+    # The files are ASCII so work in bytes rather than decoding every line.
+    ip_b = ip.encode('ascii')
+
+    # Most files won't contain the ip so check first before rewriting.
+    try:
+        data = read_if_found(host_file, ip_b)
+    except IOError:
+        print('  Error: %s probably could not be opened.' % host_file)
+        logging.error('  Error: %s probably could not be opened.' % host_file )
+        return False
+
+    if data is None:
+        return True
+
+    # Keep only the lines that don't contain the bad ip. The substring test 
+    # is cheap and rules out most lines before the full check.
+    # These files are only a few MB at most so this is all done in memory.
+    lines = data.splitlines(True)
+    kept = [line for line in lines 
+            if ip_b not in line or not contains_ip(line, ip_b)]
 
+    temp_file = None
     try:   
         # The file is readable and writable only by the creating user ID.
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        with open(host_file, 'r') as fp:
-            for line in fp:
-                if re.search(ip, line):
-                    # Found the bad ip but do nothing here because we
-                    # are writing all the good IPs to a temporary file.
-                    logging.debug('%s: deleted %s' % (host_file, ip) )
-                else:
-                    temp_file.write(line)
+        # It is created beside host_file so that it can be renamed over it.
+        # The with closes it, we only have to remove it if there's an error.
+        with tempfile.NamedTemporaryFile(delete=False, 
+                dir=os.path.dirname(host_file)) as temp_file:
+            temp_file.write(b''.join(kept))
     except IOError:
-        print '  Error: %s probably could not be opened.' % host_file 
-        logging.error('  Error: %s probably could not be opened.' % host_file )
-        temp_file.close()           # can run multiple times 
-        os.remove(temp_file.name)   # must only run once
-        status = False
-    else:
-        # This section will run if there were no exceptions. 
-        # Note: here we must use shutil.copy() and not os.rename()
-        # We also can't use shutil.move() across file systems. 
-        # You have to copy then use remove. 
-        temp_file.close()
-        shutil.copy(host_file, host_file + '_orig') 
-        shutil.copy(temp_file.name, host_file)
-        os.chmod(host_file, 0644)   # this is set to be the same as in /etc/logrotate.d/denyhosts
-        os.remove(temp_file.name)   # must only run once
-        status = True
-    finally: 
-        # This section will always be run. 
-        temp_file.close()
+        print('  Error: could not write a new copy of %s.' % host_file)
+        logging.error('  Error: could not write a new copy of %s.' % host_file )
+        if temp_file is not None:
+            os.unlink(temp_file.name)
+        return False
 
-    return status
+    # The temp file is on the same file system as host_file so 
+    # os.replace() can atomically rename it over host_file. 
+    # If the snapshot can't be made we don't touch host_file at all.
+    # If the rename fails, a snapshot made here is removed again, otherwise 
+    # a hard link would follow the live file as denyhosts appends to it.
+    snap_file = None
+    try:
+        snap_file = snapshot_file(host_file)
+        st = os.stat(host_file)
+        os.chown(temp_file.name, st.st_uid, st.st_gid)
+        os.chmod(temp_file.name, 0o644)   # this is set to be the same as in /etc/logrotate.d/denyhosts
+        os.replace(temp_file.name, host_file)
+    except OSError as e:
+        print('  Error: could not replace %s: %s' % (host_file, e))
+        logging.error('  Error: could not replace %s: %s' % (host_file, e))
+        os.unlink(temp_file.name)
+        if snap_file is not None:
+            os.unlink(snap_file)
+        return False
 
+    # Log once per file. Let logging do the formatting.
+    logging.info('%s: removed %d lines matching %s', 
+        host_file, len(lines) - len(kept), ip)
+
+    return True
 
 
 ##################
 # Main starts here
 ##################
 
+def start_logging():
+    '''
+    Set the logging level. Can be DEBUG, INFO (default), or ERROR only.
+    This also checks the LOGFILE can be opened. 
+    '''
+
+    try:
+        logging.basicConfig(filename=LOGFILE, level=logging.INFO, 
+            format='%(asctime)s %(message)s', datefmt='%Y.%m.%d %I:%M:%S %p')
+    except IOError:
+        print('Error, can\'t find LOGFILE %s. ' % LOGFILE)
+        print('Did you forget to change the value of this in this code?')
+        sys.exit()
+
+
+def undeny_ip(ip):
+    '''
+    Stops denyhosts, removes the ip from all the denyhosts files and then 
+    starts denyhosts again. Returns True if everything worked.
+    '''
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Log one line into the logfile. logging adds the time.
+    logging.info('deleting %s', ip)
+ 
+    # Stop denyhosts, give up if it can't be stopped.
+    if not denyhosts_action('stop'):
+        return False
+
+    # Now we process the denyhosts files ....
+    # Each file is independent and denyhosts is stopped so they can all be 
+    # done at once. Each file only touches its own temp and snapshot files.
+    # Whatever happens here denyhosts must be started again.
+    results = [False]
+    try:
+        with ThreadPoolExecutor(max_workers=len(denyhosts_files)) as executor:
+            results = list(executor.map(lambda f: delete_from_file(f, ip), denyhosts_files))
+        if not all(results):
+            logging.error('  Error: %d of %d files failed', 
+                results.count(False), len(results))
+    finally:
+        # Start denyhosts.
+        started = denyhosts_action('start')
+        if not started:
+            print('Error: can\t seem to start denyhosts again!')
+
+    return started and all(results)
+
+
+def run_daemon():
+    '''
+    Listen on SOCKET_PATH for ip addresses to undeny. Requests are handled 
+    one at a time as each one stops and starts denyhosts.
+    '''
+
+    import socket, socketserver
+
+    class UndenyHandler(socketserver.StreamRequestHandler):
+        '''
+        Handles one connection to the daemon. Each line sent is an ip 
+        address to undeny and each gets a reply line of "OK" or "Error: ...".
+        '''
+
+        def handle(self):
+            for line in self.rfile:
+                ip = line.strip().decode('ascii', 'replace')
+                if not check_valid_ip(ip):
+                    reply = 'Error: %s is not a valid IP address.' % ip
+                else:
+                    # Always reply, and keep the daemon going, whatever fails.
+                    try:
+                        ok = undeny_ip(ip)
+                    except Exception:
+                        logging.exception('  Error: undeny of %s failed', ip)
+                        ok = False
+                    reply = 'OK' if ok else 'Error: see %s' % LOGFILE
+                self.wfile.write((reply + '\n').encode('ascii', 'replace'))
+
+    # Don't take over the socket of a daemon that is still running, else 
+    # two daemons could stop and start denyhosts over each other.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(SOCKET_PATH)
+        except OSError:
+            pass    # nothing is listening
+        else:
+            print('Error: a daemon is already listening on %s' % SOCKET_PATH)
+            logging.error('  Error: a daemon is already listening on %s', SOCKET_PATH)
+            sys.exit()
+
+    # Remove a socket left behind by a previous daemon.
+    try:
+        os.unlink(SOCKET_PATH)
+    except FileNotFoundError:
+        pass
+
+    # Only root can ask us to undeny. Set the umask so the socket is 
+    # created that way rather than fixing it up after the bind.
+    old_umask = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(SOCKET_PATH, UndenyHandler)
+    finally:
+        os.umask(old_umask)
+    os.chmod(SOCKET_PATH, 0o600)
+    logging.info('listening on %s', SOCKET_PATH)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(SOCKET_PATH)
+
+
 def main():
 
     # Check user must run this script using sudo.
     if os.geteuid() != 0:
         usage()
-        print 'Error: you have to run this script as sudo.'
+        print('Error: you have to run this script as sudo.')
         sys.exit()
 
     # Check user must have supplied one arg, else exit.
-    if len(sys.argv) <> 2:
+    if len(sys.argv) != 2:
         usage()
-        print 'Error: you need to enter an ip address.'
+        print('Error: you need to enter an ip address.')
         sys.exit()
 
+    if sys.argv[1] == '--daemon':
+        start_logging()
+        run_daemon()
+        return
+
     # OK user supplied one arg, check format is a full IP addess.
     ip = sys.argv[1]
     if not check_valid_ip(ip):
         usage()
-        print 'Error: %s is not a valid IP address.' % ip
+        print('Error: %s is not a valid IP address.' % ip)
         sys.exit()
     
-    # Set the logging level. Can be DEBUG, INFO (default), or ERROR only.
-    # This also checks the LOGFILE can be opened. 
-    try:
-        logging.basicConfig(filename=LOGFILE, level=logging.INFO, format=None)
-    except IOError:
-        print 'Error, can\'t find LOGFILE %s. ' % LOGFILE
-        print 'Did you forget to change the value of this in this code?'
-        sys.exit()
-
-    # Log one line into the logfile.
-    now = datetime.datetime.now().strftime('%Y.%m.%d %I:%M:%S %p')
-    logging.info('%s  deleting %s' % (now, ip)) 
- 
-    # Stop denyhosts, exit if it can't be stopped.
-    if not denyhosts_action('stop'):
-        sys.exit()
-
-    # Now we process the denyhosts files ....
-    for host_file in denyhosts_files:
-        if not delete_from_file(host_file, ip):
-            # If there is any failure then don't try any more files.
-            logging.error('  Error: exiting loop') 
-            break
-
-    # Start denyhosts.
-    if not denyhosts_action('start'):
-        print 'Error: can\t seem to start denyhosts again!'
+    start_logging()
+    undeny_ip(ip)
 
 if __name__ == '__main__':
     main()